@@ -5,29 +5,72 @@ FastAPI + SQLite
 Este archivo es parte del proyecto Docker
 """
 
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Header, Depends, Query
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, String, Integer, Float, DateTime, Boolean
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, field_validator
+from sqlalchemy import event, select, update, delete, func, bindparam, Index, CheckConstraint, Column, String, Integer, Float, DateTime, Boolean
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime
-from typing import Optional
-import secrets
+from sqlalchemy.orm import validates
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Optional, NamedTuple
+import asyncio
+import base64
+import orjson
+import threading
+import time
 import os
 
 # ============================================
 # CONFIGURACIÓN BASE DE DATOS
 # ============================================
 DATABASE_PATH = os.getenv("DATABASE_PATH", "./data/maker_iot.db")
-SQLALCHEMY_DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+# Modo de caché de páginas de SQLite: "private" (por conexión) o "shared" (compartida
+# entre las conexiones del proceso). Con "shared" SQLite bloquea por tabla y puede
+# devolver "database table is locked" sin respetar busy_timeout bajo escrituras
+# concurrentes; mmap_size ya comparte las páginas vía el page cache del sistema.
+SQLITE_CACHE_MODE = os.getenv("SQLITE_CACHE_MODE", "private")
+SQLALCHEMY_DATABASE_URL = (
+    f"sqlite+aiosqlite:///file:{DATABASE_PATH}?cache={SQLITE_CACHE_MODE}&mode=rwc&uri=true"
+)
 
 # Crear directorio data si no existe
 os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+)
+
+# PRAGMAs de SQLite aplicados a cada conexión nueva:
+# WAL + synchronous=NORMAL evita un fsync por commit y los lectores no bloquean al escritor
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",  # 256 MB
+    "cache_size=-65536",    # 64 MB
+    "busy_timeout=5000",
+)
+
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+async_session = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # ============================================
@@ -44,6 +87,16 @@ class ActivationCode(Base):
     used_by_mac = Column(String, nullable=True)
     used_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        CheckConstraint("code = UPPER(code)", name="ck_activation_codes_code_upper"),
+        # Mantiene indexada una búsqueda por UPPER(code) aunque no se normalice
+        Index("ix_activation_codes_code_upper", func.upper(code)),
+    )
+    
+    @validates("code", "used_by_mac")
+    def _normalize_upper(self, key, value):
+        return value.upper() if value else value
 
 class Device(Base):
     __tablename__ = "devices"
@@ -55,18 +108,57 @@ class Device(Base):
     api_key = Column(String, unique=True)
     activated_at = Column(DateTime, default=datetime.utcnow)
     last_seen = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        CheckConstraint("mac_address = UPPER(mac_address)", name="ck_devices_mac_upper"),
+    )
+    
+    @validates("mac_address")
+    def _normalize_mac(self, key, value):
+        return value.upper() if value else value
 
 class SensorData(Base):
     __tablename__ = "sensor_data"
     
-    id = Column(Integer, primary_key=True, index=True)
-    mac_address = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    mac_address = Column(String)
     temperatura = Column(Float)
     humedad = Column(Float)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Lecturas de un dispositivo ordenadas por fecha sin ordenar en memoria
+        Index("ix_sensordata_mac_ts", mac_address, timestamp.desc()),
+    )
 
-# Crear tablas
-Base.metadata.create_all(bind=engine)
+class SensorDataMinute(Base):
+    """Promedios por minuto de las lecturas más antiguas que RAW_RETENTION_HOURS"""
+    __tablename__ = "sensor_data_1m"
+    
+    id = Column(Integer, primary_key=True)
+    mac_address = Column(String)
+    minute_ts = Column(DateTime)
+    temp_avg = Column(Float)
+    hum_avg = Column(Float)
+    n = Column(Integer)
+    
+    __table_args__ = (
+        Index("ix_sensordata1m_mac_ts", mac_address, minute_ts.desc(), unique=True),
+    )
+
+class JobLease(Base):
+    """Worker dueño de un trabajo periódico que debe correr en uno solo"""
+    __tablename__ = "job_leases"
+    
+    name = Column(String, primary_key=True)
+    owner = Column(String)
+    expires_at = Column(DateTime)
+
+# Consultas por clave construidas una sola vez: cada request solo pasa el valor
+# del parámetro y SQLAlchemy reutiliza el SQL ya compilado
+DEVICE_BY_API_KEY = select(Device).where(Device.api_key == bindparam("api_key"))
+DEVICE_BY_MAC = select(Device).where(Device.mac_address == bindparam("mac_address"))
+ACTIVATION_CODE_BY_CODE = select(ActivationCode).where(ActivationCode.code == bindparam("code"))
 
 # ============================================
 # MODELOS PYDANTIC (VALIDACIÓN)
@@ -74,6 +166,11 @@ Base.metadata.create_all(bind=engine)
 class ActivateRequest(BaseModel):
     code: str
     mac_address: str
+    
+    @field_validator("code", "mac_address")
+    @classmethod
+    def normalize_upper(cls, value: str) -> str:
+        return value.upper()
 
 class UpdateRequest(BaseModel):
     temperatura: float
@@ -83,14 +180,235 @@ class CreateCodeRequest(BaseModel):
     code: str
     sede_id: str
     sede_nombre: str
+    
+    @field_validator("code")
+    @classmethod
+    def normalize_upper(cls, value: str) -> str:
+        return value.upper()
+
+# ============================================
+# CACHÉ DE API KEYS
+# ============================================
+# Los dispositivos solo cambian al activarse, así que la autenticación de
+# /api/updates se resuelve en memoria sin consultar la base de datos
+class DeviceInfo(NamedTuple):
+    id: int
+    mac_address: str
+    sede_nombre: str
+
+API_KEY_CACHE: dict[str, DeviceInfo] = {}
+
+def cache_device(device: Device):
+    API_KEY_CACHE[device.api_key] = DeviceInfo(device.id, device.mac_address, device.sede_nombre)
+
+async def load_api_key_cache():
+    """Cargar todas las API keys registradas en la caché"""
+    async with async_session() as db:
+        result = await db.execute(select(Device))
+        API_KEY_CACHE.clear()
+        for device in result.scalars():
+            cache_device(device)
+
+async def get_device_by_api_key(api_key: str) -> Optional[DeviceInfo]:
+    """Buscar dispositivo por API key (caché primero, base de datos si no está)"""
+    info = API_KEY_CACHE.get(api_key)
+    if info is None:
+        # Puede haber sido activado por otro proceso: confirmar en la base de datos
+        async with async_session() as db:
+            result = await db.execute(DEVICE_BY_API_KEY, {"api_key": api_key})
+            device = result.scalar_one_or_none()
+        if device:
+            cache_device(device)
+            info = API_KEY_CACHE[api_key]
+    return info
+
+# ============================================
+# ESCRITURA POR LOTES DE LECTURAS
+# ============================================
+# /api/updates solo encola la lectura; una tarea de fondo la guarda junto con
+# las demás en una única transacción (un fsync por lote en vez de uno por POST)
+SENSOR_BATCH_SIZE = 500
+SENSOR_FLUSH_INTERVAL = 0.2  # segundos
+SENSOR_RETRY_MAX_DELAY = 30  # segundos entre reintentos si falla un lote
+# Cola acotada: si el escritor se atrasa, /api/updates responde 503 y el ESP32
+# reintenta, en vez de acumular lecturas en memoria sin límite
+SENSOR_QUEUE_MAXSIZE = 10_000
+# Al apagar, tiempo máximo para guardar lo pendiente; después se descarta y se avisa
+SENSOR_SHUTDOWN_TIMEOUT = 10  # segundos
+
+sensor_queue: asyncio.Queue = asyncio.Queue(maxsize=SENSOR_QUEUE_MAXSIZE)
+
+async def flush_sensor_batch(batch):
+    """Insertar un lote de lecturas y actualizar last_seen de sus dispositivos"""
+    last_seen = {}
+    for row in batch:
+        last_seen[row["mac_address"]] = row["timestamp"]
+    
+    devices = Device.__table__
+    async with engine.begin() as conn:
+        await conn.execute(SensorData.__table__.insert(), batch)
+        await conn.execute(
+            update(devices)
+            .where(devices.c.mac_address == bindparam("mac"))
+            .values(last_seen=bindparam("seen")),
+            [{"mac": mac, "seen": seen} for mac, seen in last_seen.items()]
+        )
+
+async def sensor_writer():
+    """Vaciar la cola de lecturas cada SENSOR_FLUSH_INTERVAL o SENSOR_BATCH_SIZE filas"""
+    running = True
+    batch = []
+    try:
+        while running:
+            batch = [await sensor_queue.get()]
+            await asyncio.sleep(SENSOR_FLUSH_INTERVAL)
+            while len(batch) < SENSOR_BATCH_SIZE and not sensor_queue.empty():
+                batch.append(sensor_queue.get_nowait())
+            
+            # None es la señal de apagado: se guarda lo pendiente y se termina
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            
+            # Las lecturas ya fueron confirmadas al ESP32: si el lote falla (p. ej. la
+            # base sigue bloqueada pasado busy_timeout) se reintenta, no se descarta
+            delay = SENSOR_FLUSH_INTERVAL
+            while batch:
+                try:
+                    await flush_sensor_batch(batch)
+                    batch = []
+                except Exception as e:
+                    print(f"❌ Error guardando {len(batch)} lecturas, reintento en {delay:.1f} s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, SENSOR_RETRY_MAX_DELAY)
+    except asyncio.CancelledError:
+        # lifespan cancela la tarea si no terminó en SENSOR_SHUTDOWN_TIMEOUT
+        dropped = len(batch)
+        while not sensor_queue.empty():
+            if sensor_queue.get_nowait() is not None:
+                dropped += 1
+        if dropped:
+            print(f"❌ Apagado: se descartan {dropped} lecturas sin guardar")
+        raise
+
+# ============================================
+# AGREGACIÓN POR MINUTO (ROLLUP)
+# ============================================
+# sensor_data guarda solo las últimas RAW_RETENTION_HOURS horas a resolución
+# completa; lo anterior se resume por (mac_address, minuto) en sensor_data_1m
+RAW_RETENTION_HOURS = int(os.getenv("RAW_RETENTION_HOURS", "48"))
+ROLLUP_INTERVAL = 60  # segundos
+# Filas de sensor_data por transacción: el lock de escritura se suelta entre tramos
+# para que /api/activate, /api/activation-codes y el escritor de lecturas no esperen
+ROLLUP_SLICE_ROWS = 20_000
+ROLLUP_LEASE = "rollup"
+WORKER_ID = f"{os.getpid()}-{os.urandom(4).hex()}"
+
+async def acquire_lease(name: str, ttl: timedelta) -> bool:
+    """Tomar o renovar el lease de un trabajo; False si otro worker lo tiene vigente"""
+    now = datetime.utcnow()
+    stmt = sqlite_insert(JobLease).values(name=name, owner=WORKER_ID, expires_at=now + ttl)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[JobLease.name],
+        set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at},
+        where=(JobLease.owner == WORKER_ID) | (JobLease.expires_at < now)
+    )
+    async with engine.begin() as conn:
+        await conn.execute(stmt)
+        owner = await conn.scalar(select(JobLease.owner).where(JobLease.name == name))
+    return owner == WORKER_ID
+
+async def rollup_sensor_data():
+    """Promediar por minuto las lecturas vencidas, guardarlas en sensor_data_1m y borrarlas"""
+    cutoff = (datetime.utcnow() - timedelta(hours=RAW_RETENTION_HOURS)).replace(second=0, microsecond=0)
+    minute = func.strftime("%Y-%m-%d %H:%M:00.000000", SensorData.timestamp)
+    
+    while True:
+        # Los id crecen con el tiempo: si la fila más antigua no venció, no queda nada
+        async with engine.connect() as conn:
+            oldest = (await conn.execute(
+                select(SensorData.id, SensorData.timestamp).order_by(SensorData.id).limit(1)
+            )).first()
+        if oldest is None or oldest.timestamp >= cutoff:
+            return
+        
+        in_slice = (
+            (SensorData.id >= oldest.id)
+            & (SensorData.id < oldest.id + ROLLUP_SLICE_ROWS)
+            & (SensorData.timestamp < cutoff)
+        )
+        stmt = sqlite_insert(SensorDataMinute).from_select(
+            ["mac_address", "minute_ts", "temp_avg", "hum_avg", "n"],
+            select(
+                SensorData.mac_address, minute,
+                func.avg(SensorData.temperatura), func.avg(SensorData.humedad), func.count()
+            )
+            .where(in_slice)
+            .group_by(SensorData.mac_address, minute)
+        )
+        # Un minuto puede quedar repartido entre dos tramos: se combina con lo ya guardado
+        n = SensorDataMinute.n + stmt.excluded.n
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SensorDataMinute.mac_address, SensorDataMinute.minute_ts],
+            set_={
+                "temp_avg": (SensorDataMinute.temp_avg * SensorDataMinute.n + stmt.excluded.temp_avg * stmt.excluded.n) / n,
+                "hum_avg": (SensorDataMinute.hum_avg * SensorDataMinute.n + stmt.excluded.hum_avg * stmt.excluded.n) / n,
+                "n": n,
+            }
+        )
+        async with engine.begin() as conn:
+            await conn.execute(stmt)
+            await conn.execute(delete(SensorData).where(in_slice))
+        
+        # Dar paso a los requests que esperan el lock antes del siguiente tramo
+        await asyncio.sleep(0.05)
+
+async def rollup_worker():
+    """Ejecutar rollup_sensor_data() cada ROLLUP_INTERVAL segundos en un solo worker"""
+    while True:
+        await asyncio.sleep(ROLLUP_INTERVAL)
+        try:
+            # Si el worker dueño muere, el lease vence y otro lo toma en su siguiente vuelta
+            if await acquire_lease(ROLLUP_LEASE, timedelta(seconds=3 * ROLLUP_INTERVAL)):
+                await rollup_sensor_data()
+        except Exception as e:
+            print(f"❌ Error agregando lecturas por minuto: {e}")
 
 # ============================================
 # FASTAPI APP
 # ============================================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Crear tablas y datos iniciales al arrancar, liberar conexiones al apagar"""
+    async with engine.begin() as conn:
+        await conn.run_sync(create_tables)
+    await init_database()
+    await load_api_key_cache()
+    writer = asyncio.create_task(sensor_writer())
+    rollup = asyncio.create_task(rollup_worker())
+    yield
+    rollup.cancel()
+    await asyncio.gather(rollup, return_exceptions=True)
+    try:
+        sensor_queue.put_nowait(None)
+    except asyncio.QueueFull:
+        pass  # sin lugar para la señal: el escritor se cancela al vencer el plazo
+    try:
+        await asyncio.wait_for(writer, SENSOR_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    await engine.dispose()
+
+# Las respuestas JSON se devuelven ya armadas como ORJSONResponse: FastAPI no pasa
+# por jsonable_encoder ni valida con response_model. Pydantic solo se usa para
+# validar lo que envían los ESP32 y clientes (ActivateRequest, UpdateRequest,
+# CreateCodeRequest); los formatos de respuesta son fijos y se arman a mano.
 app = FastAPI(
     title="Red Maker IoT API",
     version="1.0.0",
-    description="Backend para sensores ESP32 de temperatura y humedad"
+    description="Backend para sensores ESP32 de temperatura y humedad",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS (permitir peticiones desde cualquier origen)
@@ -102,69 +420,112 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compresión gzip (panel HTML y listados JSON); nivel 4 para gastar poca CPU
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=4)
+
 # ============================================
 # FUNCIONES AUXILIARES
 # ============================================
+# Los bytes aleatorios se piden al sistema de a 4 KB (~85 API keys por os.urandom)
+API_KEY_BYTES = 48
+_RNG_POOL_SIZE = 4096
+_rng_pool = b""
+_rng_idx = 0
+_rng_lock = threading.Lock()
+
+def _reset_rng_pool():
+    """Descartar el pool tras un fork para que el hijo no repita bytes del padre"""
+    global _rng_pool, _rng_idx
+    _rng_pool = b""
+    _rng_idx = 0
+
+os.register_at_fork(after_in_child=_reset_rng_pool)
+
 def generate_api_key():
     """Generar API key única de 64 caracteres"""
-    return secrets.token_urlsafe(48)
+    global _rng_pool, _rng_idx
+    with _rng_lock:
+        if _rng_idx + API_KEY_BYTES > len(_rng_pool):
+            _rng_pool = os.urandom(_RNG_POOL_SIZE)
+            _rng_idx = 0
+        key_bytes = _rng_pool[_rng_idx:_rng_idx + API_KEY_BYTES]
+        _rng_idx += API_KEY_BYTES
+    return base64.urlsafe_b64encode(key_bytes).rstrip(b"=").decode("ascii")
+
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Pasar una fecha con zona horaria a UTC sin tzinfo (como se guardan en la base)"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+async def get_db():
+    """Sesión de base de datos por request (se cierra siempre al terminar)"""
+    async with async_session() as db:
+        yield db
 
 # ============================================
 # ENDPOINTS DE LA API
 # ============================================
+MAX_SENSOR_DATA_LIMIT = 10_000  # más que esto: usar /api/sensor-data-stream
+SENSOR_STREAM_BATCH = 1000
 
 @app.get("/")
-def root():
+async def root():
     """Endpoint raíz - Info del servidor"""
-    return {
+    return ORJSONResponse({
         "service": "Red Maker IoT Backend",
         "version": "1.0.0",
         "status": "online",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.utcnow(),
         "endpoints": {
             "activate": "POST /api/activate",
             "updates": "POST /api/updates",
             "devices": "GET /api/devices",
             "sensor_data": "GET /api/sensor-data/{mac_address}",
+            "sensor_data_stream": "GET /api/sensor-data-stream/{mac_address}",
             "create_code": "POST /api/activation-codes",
             "list_codes": "GET /api/activation-codes",
             "panel": "GET /panel",
             "docs": "GET /docs"
         }
-    }
+    })
 
 @app.get("/health")
-def health_check():
-    """Health check para monitoreo"""
-    db = SessionLocal()
+async def health_check():
+    """Health check (liveness) para monitoreo - no consulta la base de datos"""
+    return ORJSONResponse({
+        "status": "healthy",
+        "timestamp": datetime.utcnow()
+    })
+
+@app.get("/ready")
+async def readiness_check(db: AsyncSession = Depends(get_db)):
+    """Readiness: verifica la conexión a la base de datos contando los dispositivos"""
     try:
-        device_count = db.query(Device).count()
-        db.close()
-        return {
-            "status": "healthy",
+        # Desde la base y no desde API_KEY_CACHE, que es distinto en cada worker
+        devices = await db.scalar(select(func.count()).select_from(Device))
+        return ORJSONResponse({
+            "status": "ready",
             "database": "connected",
-            "devices": device_count,
-            "timestamp": datetime.utcnow().isoformat()
-        }
+            "devices": devices,
+            "timestamp": datetime.utcnow()
+        })
     except Exception as e:
-        return {
-            "status": "unhealthy",
+        return ORJSONResponse(status_code=503, content={
+            "status": "unavailable",
             "error": str(e),
-            "timestamp": datetime.utcnow().isoformat()
-        }
+            "timestamp": datetime.utcnow()
+        })
 
 @app.post("/api/activate")
-def activate_device(request: ActivateRequest):
+async def activate_device(request: ActivateRequest, db: AsyncSession = Depends(get_db)):
     """
     Activar un dispositivo ESP32 con código de activación
     """
-    db = SessionLocal()
-    
     try:
         # Buscar código de activación
-        activation = db.query(ActivationCode).filter(
-            ActivationCode.code == request.code.upper()
-        ).first()
+        result = await db.execute(ACTIVATION_CODE_BY_CODE, {"code": request.code})
+        activation = result.scalar_one_or_none()
         
         if not activation:
             raise HTTPException(status_code=404, detail="Código de activación no encontrado")
@@ -176,57 +537,58 @@ def activate_device(request: ActivateRequest):
             )
         
         # Verificar si el dispositivo ya existe
-        existing_device = db.query(Device).filter(
-            Device.mac_address == request.mac_address
-        ).first()
+        result = await db.execute(DEVICE_BY_MAC, {"mac_address": request.mac_address})
+        existing_device = result.scalar_one_or_none()
         
         if existing_device:
             # Dispositivo ya registrado, devolver su API key existente
-            return {
+            return ORJSONResponse({
                 "success": True,
                 "sede_id": existing_device.sede_id,
                 "sede_nombre": existing_device.sede_nombre,
                 "api_key": existing_device.api_key,
                 "message": "Dispositivo ya estaba registrado"
-            }
+            })
         
         # Generar API key
         api_key = generate_api_key()
+        now = datetime.utcnow()
         
         # Crear dispositivo
         device = Device(
             mac_address=request.mac_address,
             sede_id=activation.sede_id,
             sede_nombre=activation.sede_nombre,
-            api_key=api_key
+            api_key=api_key,
+            activated_at=now,
+            last_seen=now
         )
         db.add(device)
         
         # Marcar código como usado
         activation.is_used = True
         activation.used_by_mac = request.mac_address
-        activation.used_at = datetime.utcnow()
+        activation.used_at = now
         
-        db.commit()
+        await db.commit()
+        cache_device(device)
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "sede_id": activation.sede_id,
             "sede_nombre": activation.sede_nombre,
             "api_key": api_key,
             "message": "Dispositivo activado exitosamente"
-        }
+        })
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
-    finally:
-        db.close()
 
 @app.post("/api/updates")
-def receive_sensor_data(
+async def receive_sensor_data(
     request: UpdateRequest,
     x_api_key: str = Header(None, alias="X-API-Key")
 ):
@@ -236,169 +598,221 @@ def receive_sensor_data(
     if not x_api_key:
         raise HTTPException(status_code=401, detail="API Key requerida en header X-API-Key")
     
-    db = SessionLocal()
-    
     try:
         # Buscar dispositivo por API key
-        device = db.query(Device).filter(Device.api_key == x_api_key).first()
+        device = await get_device_by_api_key(x_api_key)
         
         if not device:
             raise HTTPException(status_code=401, detail="API Key inválida")
         
-        # Guardar datos del sensor
-        sensor_data = SensorData(
-            mac_address=device.mac_address,
-            temperatura=request.temperatura,
-            humedad=request.humedad
-        )
-        db.add(sensor_data)
-        
-        # Actualizar última conexión del dispositivo
-        device.last_seen = datetime.utcnow()
-        
-        db.commit()
+        # Encolar datos del sensor (sensor_writer los guarda por lotes
+        # y actualiza la última conexión del dispositivo)
+        timestamp = datetime.utcnow()
+        try:
+            sensor_queue.put_nowait({
+                "mac_address": device.mac_address,
+                "temperatura": request.temperatura,
+                "humedad": request.humedad,
+                "timestamp": timestamp
+            })
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Servidor ocupado, reintentar más tarde")
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "message": "Datos recibidos correctamente",
             "sede": device.sede_nombre,
             "mac_address": device.mac_address,
-            "timestamp": datetime.utcnow().isoformat()
-        }
+            "timestamp": timestamp
+        })
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
-    finally:
-        db.close()
 
 @app.get("/api/devices")
-def list_devices():
+async def list_devices(db: AsyncSession = Depends(get_db)):
     """Listar todos los dispositivos registrados"""
-    db = SessionLocal()
-    devices = db.query(Device).all()
-    db.close()
+    result = await db.execute(select(
+        Device.mac_address, Device.sede_id, Device.sede_nombre,
+        Device.activated_at, Device.last_seen
+    ))
+    devices = [
+        {
+            "mac_address": mac_address,
+            "sede_id": sede_id,
+            "sede_nombre": sede_nombre,
+            "activated_at": activated_at,
+            "last_seen": last_seen
+        }
+        for mac_address, sede_id, sede_nombre, activated_at, last_seen in result
+    ]
     
-    return {
+    return ORJSONResponse({
         "total": len(devices),
-        "devices": [
-            {
-                "mac_address": d.mac_address,
-                "sede_id": d.sede_id,
-                "sede_nombre": d.sede_nombre,
-                "activated_at": d.activated_at.isoformat(),
-                "last_seen": d.last_seen.isoformat()
-            }
-            for d in devices
-        ]
-    }
+        "devices": devices
+    })
 
 @app.get("/api/sensor-data/{mac_address}")
-def get_sensor_data(mac_address: str, limit: int = 100):
-    """Obtener datos de sensores de un dispositivo específico"""
-    db = SessionLocal()
-    data = db.query(SensorData).filter(
-        SensorData.mac_address == mac_address
-    ).order_by(SensorData.timestamp.desc()).limit(limit).all()
-    db.close()
-    
-    return {
-        "mac_address": mac_address,
-        "total_records": len(data),
-        "data": [
+async def get_sensor_data(
+    mac_address: str,
+    limit: int = Query(100, ge=1, le=MAX_SENSOR_DATA_LIMIT),
+    since: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Obtener datos de sensores de un dispositivo específico (más recientes primero).
+    Pasadas las RAW_RETENTION_HOURS horas se devuelven promedios por minuto.
+    """
+    mac_address = mac_address.upper()
+    since = to_naive_utc(since)
+    query = (
+        select(SensorData.temperatura, SensorData.humedad, SensorData.timestamp)
+        .where(SensorData.mac_address == mac_address)
+    )
+    if since:
+        query = query.where(SensorData.timestamp >= since)
+    result = await db.execute(query.order_by(SensorData.timestamp.desc()).limit(limit))
+    data = [
+        {
+            "temperatura": temperatura,
+            "humedad": humedad,
+            "timestamp": timestamp
+        }
+        for temperatura, humedad, timestamp in result
+    ]
+    
+    # Completar con el histórico agregado si el rango pedido va más allá de la retención
+    raw_cutoff = datetime.utcnow() - timedelta(hours=RAW_RETENTION_HOURS)
+    if len(data) < limit and (since is None or since < raw_cutoff):
+        query = (
+            select(SensorDataMinute.temp_avg, SensorDataMinute.hum_avg, SensorDataMinute.minute_ts)
+            .where(SensorDataMinute.mac_address == mac_address)
+        )
+        if since:
+            query = query.where(SensorDataMinute.minute_ts >= since)
+        if data:
+            query = query.where(SensorDataMinute.minute_ts < data[-1]["timestamp"])
+        result = await db.execute(
+            query.order_by(SensorDataMinute.minute_ts.desc()).limit(limit - len(data))
+        )
+        data.extend(
             {
-                "temperatura": d.temperatura,
-                "humedad": d.humedad,
-                "timestamp": d.timestamp.isoformat()
+                "temperatura": temperatura,
+                "humedad": humedad,
+                "timestamp": timestamp
             }
-            for d in data
-        ]
-    }
+            for temperatura, humedad, timestamp in result
+        )
+    
+    return ORJSONResponse({
+        "mac_address": mac_address,
+        "total_records": len(data),
+        "data": data
+    })
+
+@app.get("/api/sensor-data-stream/{mac_address}")
+async def stream_sensor_data(mac_address: str, since: Optional[datetime] = None):
+    """
+    Exportar las lecturas a resolución completa de un dispositivo como NDJSON
+    (una por línea). Se leen de a SENSOR_STREAM_BATCH filas, así la memoria no
+    crece con el total.
+    """
+    mac_address = mac_address.upper()
+    since = to_naive_utc(since)
+    query = (
+        select(SensorData.temperatura, SensorData.humedad, SensorData.timestamp)
+        .where(SensorData.mac_address == mac_address)
+        .order_by(SensorData.timestamp.desc())
+        .execution_options(yield_per=SENSOR_STREAM_BATCH)
+    )
+    if since:
+        query = query.where(SensorData.timestamp >= since)
+    
+    async def generate():
+        # Sesión propia: debe seguir abierta mientras se envía la respuesta
+        async with async_session() as db:
+            result = await db.stream(query)
+            async for temperatura, humedad, timestamp in result:
+                yield orjson.dumps({
+                    "temperatura": temperatura,
+                    "humedad": humedad,
+                    "timestamp": timestamp
+                }) + b"\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 @app.post("/api/activation-codes")
-def create_activation_code(request: CreateCodeRequest):
+async def create_activation_code(request: CreateCodeRequest, db: AsyncSession = Depends(get_db)):
     """Crear un nuevo código de activación"""
-    db = SessionLocal()
-    
     try:
         # Verificar si el código ya existe
-        existing = db.query(ActivationCode).filter(
-            ActivationCode.code == request.code.upper()
-        ).first()
+        result = await db.execute(ACTIVATION_CODE_BY_CODE, {"code": request.code})
+        existing = result.scalar_one_or_none()
         
         if existing:
             raise HTTPException(status_code=409, detail="Código ya existe")
         
         # Crear código
         code = ActivationCode(
-            code=request.code.upper(),
+            code=request.code,
             sede_id=request.sede_id,
             sede_nombre=request.sede_nombre
         )
         db.add(code)
-        db.commit()
+        await db.commit()
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "code": code.code,
             "sede_nombre": code.sede_nombre,
             "message": "Código de activación creado exitosamente"
-        }
+        })
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
-    finally:
-        db.close()
 
 @app.get("/api/activation-codes")
-def list_activation_codes():
+async def list_activation_codes(db: AsyncSession = Depends(get_db)):
     """Listar todos los códigos de activación"""
-    db = SessionLocal()
-    codes = db.query(ActivationCode).all()
-    db.close()
+    result = await db.execute(select(
+        ActivationCode.code, ActivationCode.sede_id, ActivationCode.sede_nombre,
+        ActivationCode.is_used, ActivationCode.used_by_mac,
+        ActivationCode.used_at, ActivationCode.created_at
+    ))
     
-    return {
+    # Serializar y contar usados en una sola pasada
+    used = 0
+    codes = []
+    for c in result:
+        if c.is_used:
+            used += 1
+        codes.append({
+            "code": c.code,
+            "sede_id": c.sede_id,
+            "sede_nombre": c.sede_nombre,
+            "is_used": c.is_used,
+            "used_by_mac": c.used_by_mac,
+            "used_at": c.used_at,
+            "created_at": c.created_at
+        })
+    
+    return ORJSONResponse({
         "total": len(codes),
-        "available": len([c for c in codes if not c.is_used]),
-        "used": len([c for c in codes if c.is_used]),
-        "codes": [
-            {
-                "code": c.code,
-                "sede_id": c.sede_id,
-                "sede_nombre": c.sede_nombre,
-                "is_used": c.is_used,
-                "used_by_mac": c.used_by_mac,
-                "used_at": c.used_at.isoformat() if c.used_at else None,
-                "created_at": c.created_at.isoformat()
-            }
-            for c in codes
-        ]
-    }
+        "available": len(codes) - used,
+        "used": used,
+        "codes": codes
+    })
 
-@app.get("/panel", response_class=HTMLResponse)
-def admin_panel():
-    """Panel web para visualizar dispositivos y datos"""
-    db = SessionLocal()
-    devices = db.query(Device).all()
-    codes = db.query(ActivationCode).all()
-    total_readings = db.query(SensorData).count()
-    
-    # Obtener últimas lecturas de cada dispositivo
-    latest_data = {}
-    for device in devices:
-        last_reading = db.query(SensorData).filter(
-            SensorData.mac_address == device.mac_address
-        ).order_by(SensorData.timestamp.desc()).first()
-        latest_data[device.mac_address] = last_reading
-    
-    db.close()
-    
-    html = """
+# ============================================
+# PLANTILLA DEL PANEL
+# ============================================
+# Partes estáticas del HTML; admin_panel() solo genera las filas y las une con join
+_PANEL_HEAD = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -551,28 +965,17 @@ def admin_panel():
             </div>
             
             <div class="stats">
-                <div class="stat-card">
-                    <div class="stat-value">""" + str(len(devices)) + """</div>
-                    <div class="stat-label">📱 Dispositivos Activos</div>
-                </div>
-                <div class="stat-card">
-                    <div class="stat-value">""" + str(len([c for c in codes if not c.is_used])) + """</div>
-                    <div class="stat-label">🔑 Códigos Disponibles</div>
-                </div>
-                <div class="stat-card">
-                    <div class="stat-value">""" + str(total_readings) + """</div>
-                    <div class="stat-label">📊 Lecturas Totales</div>
-                </div>
-            </div>
+"""
+
+_PANEL_DEVICES_OPEN = """            </div>
             
             <div class="content">
                 <div class="section">
                     <h2>📱 Dispositivos Registrados</h2>
                     <div class="card">
-    """
-    
-    if devices:
-        html += """
+"""
+
+_PANEL_DEVICES_TABLE = """
                         <table>
                             <thead>
                                 <tr>
@@ -585,39 +988,9 @@ def admin_panel():
                                 </tr>
                             </thead>
                             <tbody>
-        """
-        
-        for device in devices:
-            last_data = latest_data.get(device.mac_address)
-            temp = f"{last_data.temperatura:.1f}°C" if last_data else "Sin datos"
-            hum = f"{last_data.humedad:.0f}%" if last_data else "Sin datos"
-            
-            # Calcular tiempo desde última conexión
-            time_diff = (datetime.utcnow() - device.last_seen).total_seconds()
-            if time_diff < 600:  # 10 minutos
-                status = '<span class="badge badge-success"><span class="online-indicator"></span>Online</span>'
-            elif time_diff < 3600:  # 1 hora
-                status = '<span class="badge badge-warning">Inactivo</span>'
-            else:
-                status = '<span class="badge badge-danger">Offline</span>'
-            
-            html += f"""
-                                <tr>
-                                    <td>{status}</td>
-                                    <td><code>{device.mac_address}</code></td>
-                                    <td><strong>{device.sede_nombre}</strong><br><small style="color:#666;">{device.sede_id}</small></td>
-                                    <td><strong>{temp}</strong></td>
-                                    <td><strong>{hum}</strong></td>
-                                    <td>{device.last_seen.strftime('%Y-%m-%d %H:%M:%S')}</td>
-                                </tr>
-            """
-        
-        html += """
-                            </tbody>
-                        </table>
-        """
-    else:
-        html += """
+"""
+
+_PANEL_DEVICES_EMPTY = """
                         <div class="empty-state">
                             <svg xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke="currentColor">
                                 <path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M9.75 17L9 20l-1 1h8l-1-1-.75-3M3 13h18M5 17h14a2 2 0 002-2V5a2 2 0 00-2-2H5a2 2 0 00-2 2v10a2 2 0 002 2z" />
@@ -625,19 +998,18 @@ def admin_panel():
                             <h3>No hay dispositivos registrados</h3>
                             <p>Activa tu primer ESP32 con un código de activación</p>
                         </div>
-        """
-    
-    html += """
+"""
+
+_PANEL_MID = """
                     </div>
                 </div>
                 
                 <div class="section">
                     <h2>🔑 Códigos de Activación</h2>
                     <div class="card">
-    """
-    
-    if codes:
-        html += """
+"""
+
+_PANEL_CODES_TABLE = """
                         <table>
                             <thead>
                                 <tr>
@@ -649,34 +1021,9 @@ def admin_panel():
                                 </tr>
                             </thead>
                             <tbody>
-        """
-        
-        for code in codes:
-            if code.is_used:
-                status = '<span class="badge badge-danger">Usado</span>'
-                used_by = f'<code>{code.used_by_mac}</code>' if code.used_by_mac else '-'
-                used_date = code.used_at.strftime('%Y-%m-%d %H:%M:%S') if code.used_at else "-"
-            else:
-                status = '<span class="badge badge-success">Disponible</span>'
-                used_by = '-'
-                used_date = '-'
-            
-            html += f"""
-                                <tr>
-                                    <td><code style="font-size:14px;font-weight:bold;">{code.code}</code></td>
-                                    <td><strong>{code.sede_nombre}</strong><br><small style="color:#666;">{code.sede_id}</small></td>
-                                    <td>{status}</td>
-                                    <td>{used_by}</td>
-                                    <td>{used_date}</td>
-                                </tr>
-            """
-        
-        html += """
-                            </tbody>
-                        </table>
-        """
-    else:
-        html += """
+"""
+
+_PANEL_CODES_EMPTY = """
                         <div class="empty-state">
                             <svg xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke="currentColor">
                                 <path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M15 7a2 2 0 012 2m4 0a6 6 0 01-7.743 5.743L11 17H9v2H7v2H4a1 1 0 01-1-1v-2.586a1 1 0 01.293-.707l5.964-5.964A6 6 0 1121 9z" />
@@ -684,9 +1031,14 @@ def admin_panel():
                             <h3>No hay códigos de activación</h3>
                             <p>Crea códigos desde la API o base de datos</p>
                         </div>
-        """
-    
-    html += """
+"""
+
+_PANEL_TABLE_END = """
+                            </tbody>
+                        </table>
+"""
+
+_PANEL_TAIL = """
                     </div>
                 </div>
                 
@@ -697,6 +1049,7 @@ def admin_panel():
                         <li><strong>POST /api/updates</strong> - Recibir datos de sensores</li>
                         <li><strong>GET /api/devices</strong> - Listar todos los dispositivos</li>
                         <li><strong>GET /api/sensor-data/{mac_address}</strong> - Datos de un dispositivo</li>
+                        <li><strong>GET /api/sensor-data-stream/{mac_address}</strong> - Todas las lecturas (NDJSON)</li>
                         <li><strong>POST /api/activation-codes</strong> - Crear código de activación</li>
                         <li><strong>GET /api/activation-codes</strong> - Listar códigos</li>
                         <li><strong>GET /docs</strong> - Documentación interactiva (Swagger UI)</li>
@@ -716,9 +1069,150 @@ def admin_panel():
         </script>
     </body>
     </html>
-    """
+"""
+
+# El panel se refresca solo cada 30 s en cada navegador abierto: se sirve desde
+# memoria durante PANEL_CACHE_TTL segundos en vez de consultar la base cada vez
+PANEL_CACHE_TTL = 5  # segundos
+_panel_cache = (0.0, "")  # (expira_en, html)
+
+@app.get("/panel", response_class=HTMLResponse)
+async def admin_panel(db: AsyncSession = Depends(get_db)):
+    """Panel web para visualizar dispositivos y datos"""
+    global _panel_cache
+    expires_at, html = _panel_cache
+    now = time.monotonic()
+    if now >= expires_at:
+        html = await render_panel(db)
+        _panel_cache = (now + PANEL_CACHE_TTL, html)
     
-    return html
+    return HTMLResponse(html, headers={"Cache-Control": f"public, max-age={PANEL_CACHE_TTL}"})
+
+async def render_panel(db: AsyncSession) -> str:
+    """Consultar dispositivos, códigos y lecturas y generar el HTML del panel"""
+    devices = (await db.execute(select(
+        Device.mac_address, Device.sede_id, Device.sede_nombre, Device.last_seen
+    ))).all()
+    codes = (await db.execute(select(
+        ActivationCode.code, ActivationCode.sede_id, ActivationCode.sede_nombre,
+        ActivationCode.is_used, ActivationCode.used_by_mac, ActivationCode.used_at
+    ))).all()
+    total_readings = await db.scalar(select(func.count()).select_from(SensorData))
+    total_readings += await db.scalar(select(func.coalesce(func.sum(SensorDataMinute.n), 0)))
+    
+    # Obtener últimas lecturas de cada dispositivo (una sola consulta)
+    latest = (
+        select(SensorData.mac_address, func.max(SensorData.timestamp).label("timestamp"))
+        .group_by(SensorData.mac_address)
+        .subquery()
+    )
+    result = await db.execute(
+        select(SensorData.mac_address, SensorData.temperatura, SensorData.humedad)
+        .join(latest, (SensorData.mac_address == latest.c.mac_address)
+                      & (SensorData.timestamp == latest.c.timestamp))
+    )
+    latest_data = {row.mac_address: row for row in result}
+    
+    # Dispositivos sin lecturas recientes: su última lectura ya pasó a sensor_data_1m
+    if any(device.mac_address not in latest_data for device in devices):
+        latest = (
+            select(SensorDataMinute.mac_address, func.max(SensorDataMinute.minute_ts).label("minute_ts"))
+            .group_by(SensorDataMinute.mac_address)
+            .subquery()
+        )
+        result = await db.execute(
+            select(
+                SensorDataMinute.mac_address,
+                SensorDataMinute.temp_avg.label("temperatura"),
+                SensorDataMinute.hum_avg.label("humedad")
+            )
+            .join(latest, (SensorDataMinute.mac_address == latest.c.mac_address)
+                          & (SensorDataMinute.minute_ts == latest.c.minute_ts))
+        )
+        for row in result:
+            latest_data.setdefault(row.mac_address, row)
+    
+    # Armar el HTML por partes y unirlas una sola vez
+    available_codes = sum(not c.is_used for c in codes)
+    parts = [_PANEL_HEAD, f"""                <div class="stat-card">
+                    <div class="stat-value">{len(devices)}</div>
+                    <div class="stat-label">📱 Dispositivos Activos</div>
+                </div>
+                <div class="stat-card">
+                    <div class="stat-value">{available_codes}</div>
+                    <div class="stat-label">🔑 Códigos Disponibles</div>
+                </div>
+                <div class="stat-card">
+                    <div class="stat-value">{total_readings}</div>
+                    <div class="stat-label">📊 Lecturas Totales</div>
+                </div>
+""", _PANEL_DEVICES_OPEN]
+    
+    if devices:
+        parts.append(_PANEL_DEVICES_TABLE)
+        
+        now = datetime.utcnow()
+        for device in devices:
+            last_data = latest_data.get(device.mac_address)
+            temp = f"{last_data.temperatura:.1f}°C" if last_data else "Sin datos"
+            hum = f"{last_data.humedad:.0f}%" if last_data else "Sin datos"
+            
+            # Calcular tiempo desde última conexión
+            time_diff = (now - device.last_seen).total_seconds()
+            if time_diff < 600:  # 10 minutos
+                status = '<span class="badge badge-success"><span class="online-indicator"></span>Online</span>'
+            elif time_diff < 3600:  # 1 hora
+                status = '<span class="badge badge-warning">Inactivo</span>'
+            else:
+                status = '<span class="badge badge-danger">Offline</span>'
+            
+            parts.append(f"""
+                                <tr>
+                                    <td>{status}</td>
+                                    <td><code>{device.mac_address}</code></td>
+                                    <td><strong>{device.sede_nombre}</strong><br><small style="color:#666;">{device.sede_id}</small></td>
+                                    <td><strong>{temp}</strong></td>
+                                    <td><strong>{hum}</strong></td>
+                                    <td>{device.last_seen.strftime('%Y-%m-%d %H:%M:%S')}</td>
+                                </tr>
+            """)
+        
+        parts.append(_PANEL_TABLE_END)
+    else:
+        parts.append(_PANEL_DEVICES_EMPTY)
+    
+    parts.append(_PANEL_MID)
+    
+    if codes:
+        parts.append(_PANEL_CODES_TABLE)
+        
+        for code in codes:
+            if code.is_used:
+                status = '<span class="badge badge-danger">Usado</span>'
+                used_by = f'<code>{code.used_by_mac}</code>' if code.used_by_mac else '-'
+                used_date = code.used_at.strftime('%Y-%m-%d %H:%M:%S') if code.used_at else "-"
+            else:
+                status = '<span class="badge badge-success">Disponible</span>'
+                used_by = '-'
+                used_date = '-'
+            
+            parts.append(f"""
+                                <tr>
+                                    <td><code style="font-size:14px;font-weight:bold;">{code.code}</code></td>
+                                    <td><strong>{code.sede_nombre}</strong><br><small style="color:#666;">{code.sede_id}</small></td>
+                                    <td>{status}</td>
+                                    <td>{used_by}</td>
+                                    <td>{used_date}</td>
+                                </tr>
+            """)
+        
+        parts.append(_PANEL_TABLE_END)
+    else:
+        parts.append(_PANEL_CODES_EMPTY)
+    
+    parts.append(_PANEL_TAIL)
+    
+    return "".join(parts)
 
 # ============================================
 # INICIALIZACIÓN
@@ -728,42 +1222,96 @@ def admin_panel():
 # ============================================
 # INICIALIZACIÓN
 # ============================================
-def init_database():
-    """Crear códigos de activación de ejemplo si no existen"""
-    db = SessionLocal()
+def create_tables(connection):
+    """Crear tablas e índices (los índices nuevos también en bases ya existentes)"""
+    # IF NOT EXISTS: con varios workers todos crean el esquema a la vez al arrancar
+    for table in Base.metadata.sorted_tables:
+        connection.execute(CreateTable(table, if_not_exists=True))
+        for index in table.indexes:
+            # IF NOT EXISTS: la reflexión de SQLite no ve índices por expresión
+            connection.execute(CreateIndex(index, if_not_exists=True))
+    # Redundantes (el PK y el prefijo de ix_sensordata_mac_ts ya los cubren) y
+    # se pagaban en cada INSERT de lecturas: se quitan de bases existentes
+    for name in ("ix_sensor_data_id", "ix_sensor_data_mac_address"):
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+    normalize_case(connection)
+
+# Versión del esquema guardada en PRAGMA user_version
+SCHEMA_VERSION_UPPERCASE = 1
+
+def normalize_case(connection):
+    """
+    Pasar a mayúsculas códigos y MACs guardados antes de normalizarlos al escribir.
+    Se ejecuta una sola vez por base (PRAGMA user_version).
+    """
+    version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+    if version >= SCHEMA_VERSION_UPPERCASE:
+        return
     
-    try:
-        # Verificar si ya existen códigos
-        existing = db.query(ActivationCode).count()
-        if existing > 0:
-            print(f"✅ Base de datos inicializada ({existing} códigos existentes)")
-            db.close()
-            return
-        
-        # Crear códigos de ejemplo
-        sample_codes = [
-            {"code": "REM-SANPED-2025-EZPZ", "sede_id": "SANPED-001", "sede_nombre": "San Pedro Centro"},
-            {"code": "REM-SANPED-2025-TEST", "sede_id": "SANPED-002", "sede_nombre": "San Pedro Norte"},
-            {"code": "REM-POSADAS-2025-ABC", "sede_id": "POSADAS-001", "sede_nombre": "Posadas Centro"},
-            {"code": "REM-OBERA-2025-XYZ", "sede_id": "OBERA-001", "sede_nombre": "Oberá Centro"},
-            {"code": "REM-ELDORADO-2025-123", "sede_id": "ELDORADO-001", "sede_nombre": "Eldorado Centro"},
-        ]
-        
-        for data in sample_codes:
-            code = ActivationCode(**data)
-            db.add(code)
-        
-        db.commit()
-        print(f"✅ Base de datos inicializada ({len(sample_codes)} códigos creados)")
-        
-    except Exception as e:
-        print(f"❌ Error inicializando base de datos: {e}")
-        db.rollback()
-    finally:
-        db.close()
+    # Misma MAC con distinto uso de mayúsculas: queda el dispositivo que se
+    # conectó por última vez (el que tiene la API key en uso)
+    connection.exec_driver_sql("""
+        DELETE FROM devices WHERE EXISTS (
+            SELECT 1 FROM devices AS d
+            WHERE UPPER(d.mac_address) = UPPER(devices.mac_address)
+              AND d.id != devices.id
+              AND (COALESCE(d.last_seen, '') > COALESCE(devices.last_seen, '')
+                   OR (COALESCE(d.last_seen, '') = COALESCE(devices.last_seen, '') AND d.id > devices.id))
+        )
+    """)
+    # Un código en minúsculas nunca fue alcanzable (la API buscaba code.upper()):
+    # si ya existe su versión en mayúsculas, se descarta
+    connection.exec_driver_sql("""
+        DELETE FROM activation_codes WHERE code != UPPER(code) AND EXISTS (
+            SELECT 1 FROM activation_codes AS c
+            WHERE UPPER(c.code) = UPPER(activation_codes.code) AND c.id != activation_codes.id
+              AND (c.code = UPPER(c.code) OR c.id < activation_codes.id)
+        )
+    """)
+    for table, column in (
+        ("devices", "mac_address"),
+        ("activation_codes", "code"),
+        ("activation_codes", "used_by_mac"),
+        ("sensor_data", "mac_address"),
+        ("sensor_data_1m", "mac_address"),
+    ):
+        # OR IGNORE: en sensor_data_1m (mac_address, minute_ts) es único; un minuto
+        # repetido con la MAC en minúsculas se descarta a continuación
+        connection.exec_driver_sql(
+            f"UPDATE OR IGNORE {table} SET {column} = UPPER({column}) WHERE {column} != UPPER({column})"
+        )
+    connection.exec_driver_sql("DELETE FROM sensor_data_1m WHERE mac_address != UPPER(mac_address)")
+    connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION_UPPERCASE}")
+
+async def init_database():
+    """Crear códigos de activación de ejemplo si no existen"""
+    async with async_session() as db:
+        try:
+            # Verificar si ya existen códigos
+            existing = await db.scalar(select(func.count()).select_from(ActivationCode))
+            if existing > 0:
+                print(f"✅ Base de datos inicializada ({existing} códigos existentes)")
+                return
+            
+            # Crear códigos de ejemplo
+            sample_codes = [
+                {"code": "REM-SANPED-2025-EZPZ", "sede_id": "SANPED-001", "sede_nombre": "San Pedro Centro"},
+                {"code": "REM-SANPED-2025-TEST", "sede_id": "SANPED-002", "sede_nombre": "San Pedro Norte"},
+                {"code": "REM-POSADAS-2025-ABC", "sede_id": "POSADAS-001", "sede_nombre": "Posadas Centro"},
+                {"code": "REM-OBERA-2025-XYZ", "sede_id": "OBERA-001", "sede_nombre": "Oberá Centro"},
+                {"code": "REM-ELDORADO-2025-123", "sede_id": "ELDORADO-001", "sede_nombre": "Eldorado Centro"},
+            ]
+            
+            # OR IGNORE: varios workers pueden sembrar a la vez en una base nueva
+            await db.execute(ActivationCode.__table__.insert().prefix_with("OR IGNORE"), sample_codes)
+            await db.commit()
+            print(f"✅ Base de datos inicializada ({len(sample_codes)} códigos creados)")
+            
+        except Exception as e:
+            print(f"❌ Error inicializando base de datos: {e}")
+            await db.rollback()
 
-# Inicializar al arrancar
-init_database()
+# init_database() se ejecuta al arrancar desde lifespan()
 
 # ============================================
 # EJECUTAR SERVIDOR
@@ -782,6 +1330,13 @@ if __name__ == "__main__":
     print("   - Servidor: 192.168.1.4:8000")
     print("\n" + "="*60 + "\n")
     
-    # Iniciar servidor
-
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Iniciar servidor (varios procesos; uvloop + httptools para menos CPU por request)
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="uvloop",
+        http="httptools",
+        access_log=False
+    )